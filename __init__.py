@@ -2,6 +2,7 @@
 #copyright notices and license terms.
 from trytond.pool import Pool
 from . import bom
+from . import ir
 from . import product
 
 def register():
@@ -10,6 +11,7 @@ def register():
         bom.Production,
         bom.NewVersionStart,
         product.Product,
+        ir.Cron,
         module='production_bom_versions', type_='model')
     Pool.register(
         bom.OpenVersions,
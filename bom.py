@@ -1,13 +1,21 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import datetime
-from trytond.model import ModelView, Unique, Check, fields
+import logging
+from sql import Literal, Null
+from trytond.model import ModelView, Unique, Check, Index, fields
 from trytond.wizard import Wizard, StateView, Button, StateAction
 from trytond.transaction import Transaction
 from trytond.pyson import PYSONEncoder, Bool, Date, Eval, If
 from trytond.pool import Pool, PoolMeta
 from trytond.i18n import gettext
 from trytond.exceptions import UserError, UserWarning
+from trytond.tools import grouped_slice
+
+logger = logging.getLogger(__name__)
+
+# number of master boms activated by each queued task
+ACTIVATION_BATCH = 10
 
 
 class BOM(metaclass=PoolMeta):
@@ -19,6 +27,8 @@ class BOM(metaclass=PoolMeta):
     master_bom = fields.Many2One('production.bom', 'BOM', readonly=True)
     reason_change = fields.Text('Reason for Change')
     modification_made = fields.Text('Modification Made')
+    staged = fields.Boolean('Staged', readonly=True,
+        help="The version is waiting for its start date to be activated.")
 
     @classmethod
     def __setup__(cls):
@@ -31,12 +41,25 @@ class BOM(metaclass=PoolMeta):
                 Check(t, ((t.end_date == None) | (t.end_date > t.start_date))),
                 'production_bom_versions.msg_bom_end_date_check'),
             ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.end_date, Index.Range()),
+                (t.start_date, Index.Range()),
+                where=(t.staged == Literal(False)) | (t.staged == Null)))
+        cls._sql_indexes.add(
+            Index(t,
+                (t.start_date, Index.Range()),
+                where=t.staged == Literal(True)))
         cls._order.insert(0, ('version', 'DESC NULLS LAST'))
 
     @staticmethod
     def default_version():
         return 1
 
+    @staticmethod
+    def default_staged():
+        return False
+
     @staticmethod
     def default_start_date():
         pool = Pool()
@@ -49,12 +72,36 @@ class BOM(metaclass=PoolMeta):
             rec_name += " (%s)" % self.version
         return rec_name
 
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None, count=False,
+            query=False):
+        effective_on = Transaction().context.get('effective_on')
+        if effective_on:
+            domain = [domain, cls._effective_on_domain(effective_on)]
+        return super().search(domain, offset=offset, limit=limit, order=order,
+            count=count, query=query)
+
+    @classmethod
+    def _effective_on_domain(cls, date):
+        '''
+        Domain of the versions effective on date
+        (only one per master_bom as dates can not overlap)
+        '''
+        return [
+            ('staged', '=', False),
+            ('start_date', '<=', date),
+            ['OR',
+                ('end_date', '=', None),
+                ('end_date', '>=', date),
+                ],
+            ]
+
     @classmethod
     def get_last_version(cls, master_bom):
         '''
         Get latest version for master_bom
         '''
-        with Transaction().set_context(show_versions=True):
+        with Transaction().set_context(show_versions=True, effective_on=None):
             boms = cls.search([
                     ('master_bom', '=', master_bom),
                 ], order=[
@@ -72,33 +119,64 @@ class BOM(metaclass=PoolMeta):
     def check_dates(self):
         if not self.master_bom:
             return
-        with Transaction().set_context(show_versions=True):
-            domain = [
-                ('master_bom', '=', self.master_bom.id),
-                ('id', '!=', self.id),
-            ]
+        domain = [
+            ('master_bom', '=', self.master_bom.id),
+            ('id', '!=', self.id),
+        ]
+        if self.staged:
+            # a staged version must start at least two days after the start
+            # of the version it will close when it is activated
+            previous_day = self.start_date - datetime.timedelta(days=1)
+            next_day = self.start_date + datetime.timedelta(days=1)
+            domain.append(['OR', [
+                            ('staged', '=', True),
+                            ('start_date', '>=', previous_day),
+                            ('start_date', '<=', next_day),
+                        ], [
+                            ('staged', '=', False),
+                            ['OR', [
+                                    ('start_date', '>=', previous_day),
+                                ], [
+                                    ('end_date', '>=', self.start_date),
+                                ]
+                            ],
+                        ]
+                    ])
+        else:
             if not self.end_date:
-                domain.append(['OR', [
+                overlap = [['OR', [
                                 ('end_date', '=', None),
                             ], [
                                 ('end_date', '>', self.start_date),
                             ]
-                        ])
+                        ]]
+                # the staged versions will close it the day before they
+                # start, which must be after its start date
+                staged_limit = self.start_date + datetime.timedelta(days=1)
             else:
-                domain.append(('start_date', '<', self.end_date))
-                domain.append(['OR', [
-                                    ('end_date', '=', None),
-                                ], [
-                                    ('end_date', '>', self.start_date),
-                                ]
-                            ])
-            with Transaction().set_context(show_versions=True):
-                boms = self.search(domain, limit=1)
-                if boms:
-                    raise UserError(gettext('production_bom_versions.'
-                            'msg_invalid_dates',
-                            bom=self.rec_name,
-                            version=boms[0].version))
+                overlap = [('start_date', '<', self.end_date),
+                    ['OR', [
+                            ('end_date', '=', None),
+                        ], [
+                            ('end_date', '>', self.start_date),
+                        ]
+                    ]]
+                staged_limit = self.end_date
+            domain.append(['OR', [
+                            ('staged', '=', False),
+                        ] + overlap, [
+                            ('staged', '=', True),
+                            ('start_date', '<=', staged_limit),
+                        ]
+                    ])
+        with Transaction().set_context(show_versions=True, effective_on=None):
+            boms = self.search(domain, limit=1)
+            if boms:
+                raise UserError(gettext('production_bom_versions.'
+                        'msg_invalid_dates',
+                        bom=self.rec_name,
+                        version=boms[0].version))
+
     @classmethod
     def create(cls, vlist):
         boms = super(BOM, cls).create(vlist)
@@ -114,6 +192,7 @@ class BOM(metaclass=PoolMeta):
             default = {}
         else:
             default = default.copy()
+        default.setdefault('staged', False)
 
         if not Transaction().context.get('new_version', False):
             default['master_bom'] = None
@@ -129,12 +208,19 @@ class BOM(metaclass=PoolMeta):
 
     @classmethod
     def new_version(cls, boms, date, reason_change, modification_made):
+        '''
+        Create a new version of boms effective from date.
+        Versions starting in the future are staged and activated by the
+        activate_staged_versions cron.
+        '''
         pool = Pool()
-        ProductBOM = pool.get('product.product-production.bom')
+        Date = pool.get('ir.date')
 
-        cls.write(boms, {
-            'end_date': date - datetime.timedelta(days=1),
-            })
+        staged = date > Date.today()
+        if not staged:
+            cls.write(boms, {
+                'end_date': date - datetime.timedelta(days=1),
+                })
 
         with Transaction().set_context(new_version=True):
             new_boms = cls.copy(boms, {
@@ -142,25 +228,154 @@ class BOM(metaclass=PoolMeta):
                     'start_date': date,
                     'reason_change': reason_change,
                     'modification_made': modification_made,
+                    'staged': staged,
                     })
 
-        # relate new version BOMs to the product in case source bom is related to the product
+        if not staged:
+            cls.link_products(new_boms)
+        return new_boms
+
+    @classmethod
+    def link_products(cls, new_boms):
+        '''
+        Relate new_boms to the products any version of their master bom is
+        related to
+        '''
+        pool = Pool()
+        ProductBOM = pool.get('product.product-production.bom')
+
         existing_keys = set((pb.product.id, pb.bom.master_bom)
-            for pb in ProductBOM.search([('bom', 'in', boms)]))
+            for pb in ProductBOM.search([
+                    ('bom.master_bom', 'in',
+                        list({b.master_bom.id for b in new_boms})),
+                    ]))
+        linked = set((pb.product.id, pb.bom.id)
+            for pb in ProductBOM.search([('bom', 'in', new_boms)]))
 
         to_save = []
         for new_bom in new_boms:
             for output in new_bom.outputs:
                 key = (output.product.id, new_bom.master_bom)
-                if key in existing_keys:
+                if (key in existing_keys
+                        and (output.product.id, new_bom.id) not in linked):
                     to_save += [ProductBOM(
                             product=output.product,
                             bom=new_bom,
                             )]
+                    linked.add((output.product.id, new_bom.id))
+        ProductBOM.save(to_save)
+
+    @classmethod
+    def activate_staged_versions(cls, date=None):
+        '''
+        Activate the staged versions starting on or before date.
+        Versions are activated in chunks of master boms on the queue.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
 
+        if date is None:
+            date = Date.today()
+        with Transaction().set_context(show_versions=True, effective_on=None):
+            boms = cls.search([
+                    ('staged', '=', True),
+                    ('start_date', '<=', date),
+                    ])
 
-        ProductBOM.save(to_save)
-        return new_boms
+        # all versions of a master bom must be activated in the same task
+        masters = {}
+        for bom in boms:
+            masters.setdefault(bom.master_bom.id, []).append(bom)
+        for sub_masters in grouped_slice(
+                list(masters.values()), count=ACTIVATION_BATCH):
+            cls.__queue__.activate_versions(
+                [b for versions in sub_masters for b in versions])
+
+    @classmethod
+    def activate_versions(cls, boms):
+        '''
+        Close the current version of the staged boms, relate them to the
+        products and clear their staged flag. Already activated boms are
+        ignored and the versions of a master bom whose dates would not be
+        valid once activated are left staged.
+        '''
+        masters = {}
+        for bom in sorted([b for b in boms if b.staged],
+                key=lambda b: (b.start_date, b.version)):
+            masters.setdefault(bom.master_bom.id, []).append(bom)
+        if not masters:
+            return
+
+        with Transaction().set_context(show_versions=True, effective_on=None):
+            others = cls.search([
+                    ('master_bom', 'in', list(masters.keys())),
+                    ('id', 'not in', [b.id for v in masters.values()
+                            for b in v]),
+                    ])
+        dates = {}
+        pending = {}
+        current = {}
+        for bom in others:
+            if bom.staged:
+                pending.setdefault(bom.master_bom.id, []).append(
+                    bom.start_date)
+            else:
+                dates.setdefault(bom.master_bom.id, {})[bom.id] = (
+                    bom.start_date, bom.end_date)
+                if not bom.end_date:
+                    current[bom.master_bom.id] = bom
+
+        to_write = []
+        to_activate = []
+        for master, versions in masters.items():
+            writes = []
+            master_dates = dates.get(master, {})
+            predecessor = current.get(master)
+            valid = True
+            for bom in versions:
+                end_date = bom.start_date - datetime.timedelta(days=1)
+                if predecessor:
+                    if predecessor.start_date >= end_date:
+                        valid = False
+                        break
+                    writes.extend(([predecessor], {
+                            'end_date': end_date,
+                            }))
+                    master_dates[predecessor.id] = (
+                        predecessor.start_date, end_date)
+                master_dates[bom.id] = (bom.start_date, None)
+                predecessor = bom
+            if not valid or not cls._check_activation_dates(
+                    master_dates.values(), pending.get(master, [])):
+                logger.warning('Can not activate the staged versions of '
+                    'BOM "%s".', versions[0].master_bom.rec_name)
+                continue
+            to_write.extend(writes)
+            to_activate.extend(versions)
+        if not to_activate:
+            return
+
+        cls.write(*to_write, to_activate, {
+                'staged': False,
+                })
+        cls.link_products(to_activate)
+
+    @classmethod
+    def _check_activation_dates(cls, dates, pending):
+        '''
+        Check the (start_date, end_date) of the activated versions of a
+        master bom follow the rules of check_dates
+        '''
+        dates = sorted(dates, key=lambda d: d[0])
+        for (_, end_date), (start_date, _) in zip(dates, dates[1:]):
+            if not end_date or start_date < end_date:
+                return False
+        for start_date, end_date in dates:
+            staged_limit = (end_date
+                or start_date + datetime.timedelta(days=1))
+            if any(p <= staged_limit for p in pending):
+                return False
+        return True
 
 
 class Production(metaclass=PoolMeta):
@@ -170,15 +385,11 @@ class Production(metaclass=PoolMeta):
     @classmethod
     def __setup__(cls):
         super(Production, cls).__setup__()
-        cls.bom.domain += [If((Eval('state').in_(['request', 'draft'])) & ~Bool(Eval('bom', False)),
-            [
-                ('start_date', '<=', If(Bool(Eval('effective_date')), Eval('effective_date'), Eval('planned_date', Date()))),
-                ['OR',
-                    ('end_date', '>=', If(Bool(Eval('effective_date')), Eval('effective_date'), Eval('planned_date', Date()))),
-                    ('end_date', '=', None),
-                ]
-            ],
-            ())]
+        cls.bom.search_context['effective_on'] = If(
+            Eval('state').in_(['request', 'draft']),
+            If(Bool(Eval('effective_date')), Eval('effective_date'),
+                Eval('planned_date', Date())),
+            None)
 
     @fields.depends('effective_date', 'planned_date', 'bom')
     def on_change_with_bom_valid(self, name=None):
@@ -2,9 +2,14 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import datetime as dt
-from trytond.modules.company.tests import CompanyTestMixin
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.model.modelstorage import EvalEnvironment
+from trytond.exceptions import UserError
 from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder, PYSONEncoder
+from trytond.transaction import Transaction
 
 
 class ProductionBomVersionsTestCase(CompanyTestMixin, ModuleTestCase):
@@ -48,4 +53,228 @@ class ProductionBomVersionsTestCase(CompanyTestMixin, ModuleTestCase):
         production.planned_date = yesterday
         self.assertEqual(production.bom_valid, True)
 
+    @with_transaction()
+    def test_bom_effective_on(self):
+        "Test bom search effective_on"
+        pool = Pool()
+        Bom = pool.get('production.bom')
+
+        today = dt.date.today()
+        yesterday = today - dt.timedelta(days=1)
+        before_yesterday = today - dt.timedelta(days=2)
+
+        bom1 = Bom()
+        bom1.name = 'Test1'
+        bom1.start_date = before_yesterday
+        bom1.save()
+
+        bom2, = Bom.new_version([bom1], today, None, None)
+
+        bom3 = Bom()
+        bom3.name = 'Test3'
+        bom3.start_date = today
+        bom3.save()
+
+        with Transaction().set_context(effective_on=yesterday):
+            self.assertEqual(Bom.search([]), [bom1])
+        with Transaction().set_context(effective_on=today):
+            self.assertEqual(
+                sorted(Bom.search([]), key=lambda b: b.id), [bom2, bom3])
+            self.assertEqual(Bom.search([], count=True), 2)
+
+    @with_transaction()
+    def test_bom_staged_version(self):
+        "Test bom staged version activation"
+        pool = Pool()
+        Bom = pool.get('production.bom')
+
+        today = dt.date.today()
+        tomorrow = today + dt.timedelta(days=1)
+        yesterday = today - dt.timedelta(days=1)
+
+        bom1 = Bom()
+        bom1.name = 'Test1'
+        bom1.start_date = yesterday
+        bom1.save()
+
+        bom2, = Bom.new_version([bom1], tomorrow, None, None)
+        self.assertEqual(bom2.staged, True)
+        self.assertEqual(bom1.end_date, None)
+
+        with Transaction().set_context(effective_on=tomorrow):
+            self.assertEqual(Bom.search([]), [bom1])
+
+        Bom.activate_versions([bom2])
+        self.assertEqual(bom2.staged, False)
+        self.assertEqual(bom1.end_date, today)
+
+        # activation is idempotent
+        Bom.activate_versions([bom2])
+        self.assertEqual(bom1.end_date, today)
+
+        with Transaction().set_context(effective_on=tomorrow):
+            self.assertEqual(Bom.search([]), [bom2])
+
+    @with_transaction()
+    def test_production_bom_effective_on(self):
+        "Test production bom context effective_on"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Bom = pool.get('production.bom')
+        BomOutput = pool.get('production.bom.output')
+        Production = pool.get('production')
+
+        today = dt.date.today()
+        yesterday = today - dt.timedelta(days=1)
+        before_yesterday = today - dt.timedelta(days=2)
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template = Template(name='Product', default_uom=unit,
+                type='goods', producible=True)
+            template.save()
+            product = Product(template=template)
+            product.save()
+
+            bom1 = Bom(name='Test1', start_date=before_yesterday,
+                end_date=yesterday, outputs=[
+                    BomOutput(product=product, quantity=1, unit=unit)])
+            bom1.save()
+            bom2 = Bom(name='Test2', start_date=today, outputs=[
+                    BomOutput(product=product, quantity=1, unit=unit)])
+            bom2.save()
+
+            production = Production(state='draft', planned_date=today,
+                product=product, unit=unit, quantity=1)
+
+            def bom_context():
+                env = EvalEnvironment(production, Production)
+                return PYSONDecoder(env).decode(
+                    PYSONEncoder().encode(Production.bom.search_context))
+
+            context = bom_context()
+            self.assertEqual(context['effective_on'], today)
+            with Transaction().set_context(context):
+                self.assertEqual(
+                    Bom.search([('output_products', '=', product.id)]),
+                    [bom2])
+
+            # a bom not effective on the production date is allowed
+            production.bom = bom1
+            self.assertEqual(bom_context()['effective_on'], today)
+            production.save()
+            self.assertEqual(production.state, 'draft')
+            self.assertEqual(production.bom_valid, False)
+
+    @with_transaction()
+    def test_bom_activate_staged_versions(self):
+        "Test bom activate staged versions cron"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Bom = pool.get('production.bom')
+        BomOutput = pool.get('production.bom.output')
+        ProductBom = pool.get('product.product-production.bom')
+        Queue = pool.get('ir.queue')
+
+        today = dt.date.today()
+        yesterday = today - dt.timedelta(days=1)
+        tomorrow = today + dt.timedelta(days=1)
+        after_tomorrow = today + dt.timedelta(days=2)
+        later = today + dt.timedelta(days=3)
+        far = today + dt.timedelta(days=30)
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template = Template(name='Product', default_uom=unit,
+                type='goods', producible=True)
+            template.save()
+            product = Product(template=template)
+            product.save()
+            product2 = Product(template=template)
+            product2.save()
+
+            bom1 = Bom(name='Test1', start_date=yesterday, outputs=[
+                    BomOutput(product=product, quantity=1, unit=unit)])
+            bom1.save()
+            ProductBom(product=product, bom=bom1).save()
+            bom4 = Bom(name='Test4', start_date=yesterday)
+            bom4.save()
+            # a master bom without current version
+            bom6 = Bom(name='Test6', start_date=yesterday, end_date=today,
+                outputs=[BomOutput(product=product2, quantity=1, unit=unit)])
+            bom6.save()
+            ProductBom(product=product2, bom=bom6).save()
+
+            # the higher version starts first
+            bom2, = Bom.new_version([bom1], later, None, None)
+            bom3, = Bom.new_version([bom1], tomorrow, None, None)
+            bom5, = Bom.new_version([bom4], far, None, None)
+            bom7, = Bom.new_version([bom6], later, None, None)
+            self.assertEqual((bom2.version, bom3.version), (2, 3))
+
+            Bom.activate_staged_versions(later)
+            for task in Queue.search([]):
+                task.run()
+
+            self.assertEqual(
+                [(b.staged, b.end_date) for b in [bom1, bom3, bom2]],
+                [(False, today), (False, after_tomorrow), (False, None)])
+            self.assertEqual((bom4.end_date, bom5.staged), (None, True))
+            self.assertEqual(
+                sorted(pb.bom.id for pb in ProductBom.search([
+                            ('product', '=', product.id),
+                            ])),
+                sorted([bom1.id, bom2.id, bom3.id]))
+            self.assertEqual(bom7.staged, False)
+            self.assertEqual(
+                sorted(pb.bom.id for pb in ProductBom.search([
+                            ('product', '=', product2.id),
+                            ])),
+                sorted([bom6.id, bom7.id]))
+
+            # activation is idempotent
+            Bom.activate_versions([bom2, bom3])
+            self.assertEqual(bom3.end_date, after_tomorrow)
+            self.assertEqual(
+                ProductBom.search([('product', '=', product.id)], count=True),
+                3)
+
+            # staged versions can not clash with other versions
+            with self.assertRaises(UserError):
+                Bom.new_version([bom5], far + dt.timedelta(days=1), None, None)
+
+            # the current version can not overlap a staged version
+            with self.assertRaises(UserError):
+                Bom.write([bom4], {
+                        'end_date': far + dt.timedelta(days=20),
+                        })
+
+    @with_transaction()
+    def test_bom_check_activation_dates(self):
+        "Test bom check activation dates"
+        pool = Pool()
+        Bom = pool.get('production.bom')
+
+        today = dt.date.today()
+        yesterday = today - dt.timedelta(days=1)
+        tomorrow = today + dt.timedelta(days=1)
+        later = today + dt.timedelta(days=3)
+
+        self.assertEqual(Bom._check_activation_dates(
+                [(tomorrow, None), (yesterday, today)], [later]), True)
+        self.assertEqual(Bom._check_activation_dates(
+                [(yesterday, None), (tomorrow, None)], []), False)
+        self.assertEqual(Bom._check_activation_dates(
+                [(yesterday, later), (tomorrow, None)], []), False)
+        self.assertEqual(Bom._check_activation_dates(
+                [(yesterday, None)], [today]), False)
+        self.assertEqual(Bom._check_activation_dates(
+                [(yesterday, later)], [later]), False)
+
 del ModuleTestCase